@@ -1,18 +1,56 @@
 import os
+import re
 import sys
 import csv
+import bisect
 import json
 import yaml
 import hashlib
 import time
-import urllib.request
-import urllib.parse
 import xml.etree.ElementTree as ET
 import requests
 
+from requests.adapters import HTTPAdapter
+
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Optional
+
+try:
+    # LibYAML based loader, if PyYAML was built with it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    # OpenSSL's PKCS5_PBKDF2_HMAC via pyca/cryptography, if installed
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+except ImportError:
+    PBKDF2HMAC = None
+
+try:
+    # Aho-Corasick automaton for the exclude terms, if pyahocorasick is installed
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    # Native JSON parser working directly on the response bytes, if installed
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 LOGIN_SID_ROUTE = "/login_sid.lua?version=2"
+CSV_BUFFER_SIZE = 1 << 16
+LAST_TIMESTAMP_SUFFIX = ".last_ts"
+# Number of exclude strings from which a combined scanner beats single substring checks
+EXCLUDE_SCAN_MIN_TERMS = 12
+
+# One keep-alive session for all requests to the FritzBox
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
 class LoginState:
     def __init__(self, challenge: str, blocktime: int):
@@ -27,6 +65,37 @@ class LoginState:
         self.blocktime = blocktime
         self.is_pbkdf2 = challenge.startswith("2$")
 
+class XMLFieldCollector:
+    def __init__(self, tags: tuple):
+        """
+        Initializes a parser target that only collects the text of some child elements of the root.
+
+        Parameters:
+            tags (tuple): The tags of the child elements to collect.
+        """
+        self.tags = tags
+        self.fields = {}
+        self.depth = 0
+        self.current = None
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.depth == 2 and tag in self.tags:
+            self.current = []
+
+    def data(self, data):
+        if self.current is not None:
+            self.current.append(data)
+
+    def end(self, tag):
+        if self.depth == 2 and self.current is not None:
+            self.fields[tag] = "".join(self.current)
+            self.current = None
+        self.depth -= 1
+
+    def close(self) -> dict:
+        return self.fields
+
 def get_sid(box_url: str, username: str, password: str) -> str:
     """
     Retrieves the session ID (SID) for a given user by performing the login process.
@@ -49,14 +118,24 @@ def get_sid(box_url: str, username: str, password: str) -> str:
 
     if state.is_pbkdf2:
         print("PBKDF2 supported")
-        challenge_response = calculate_pbkdf2_response(state.challenge, password)
+        calculate_response = calculate_pbkdf2_response
+        # Encode the password once, in the form the response needs
+        password_bytes = password.encode()
     else:
         print("Falling back to MD5")
-        challenge_response = calculate_md5_response(state.challenge, password)
+        calculate_response = calculate_md5_response
+        # the legacy response needs utf_16_le encoding
+        password_bytes = password.encode("utf_16_le")
 
     if state.blocktime > 0:
-        print(f"Waiting for {state.blocktime} seconds...")
-        time.sleep(state.blocktime)
+        # Calculate the response in the background while waiting out the blocktime
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            response_future = executor.submit(calculate_response, state.challenge, password_bytes)
+            print(f"Waiting for {state.blocktime} seconds...")
+            time.sleep(state.blocktime)
+            challenge_response = response_future.result()
+    else:
+        challenge_response = calculate_response(state.challenge, password_bytes)
 
     try:
         sid = send_response(box_url, username, challenge_response)
@@ -79,19 +158,35 @@ def get_login_state(box_url: str) -> LoginState:
         LoginState: A LoginState object containing challenge and blocktime information.
     """
     url = box_url + LOGIN_SID_ROUTE
-    http_response = urllib.request.urlopen(url)
-    xml = ET.fromstring(http_response.read())
-    challenge = xml.find("Challenge").text
-    blocktime = int(xml.find("BlockTime").text)
+    http_response = SESSION.get(url)
+    http_response.raise_for_status()
+    xml = read_xml_fields(http_response.content, "Challenge", "BlockTime")
+    challenge = xml["Challenge"]
+    blocktime = int(xml["BlockTime"])
     return LoginState(challenge, blocktime)
 
-def calculate_pbkdf2_response(challenge: str, password: str) -> str:
+def read_xml_fields(content: bytes, *tags: str) -> dict:
+    """
+    Parses an XML document without building a tree and returns the text of the given child elements of the root.
+
+    Parameters:
+        content (bytes): The XML document.
+        *tags (str): The tags of the child elements to return.
+
+    Returns:
+        dict: The text of the found elements by tag.
+    """
+    parser = ET.XMLParser(target=XMLFieldCollector(tags))
+    parser.feed(content)
+    return parser.close()
+
+def calculate_pbkdf2_response(challenge: str, password: bytes) -> str:
     """
     Calculates the PBKDF2 response for the given challenge and password.
 
     Parameters:
         challenge (str): The challenge string received during login.
-        password (str): The user's password.
+        password (bytes): The user's password, encoded as UTF-8.
 
     Returns:
         str: The PBKDF2 response in the format "salt2$hash2_hex".
@@ -103,29 +198,79 @@ def calculate_pbkdf2_response(challenge: str, password: str) -> str:
     iter2 = int(challenge_parts[3])
     salt2 = bytes.fromhex(challenge_parts[4])
     # Hash twice, once with static salt...
-    hash1 = hashlib.pbkdf2_hmac("sha256", password.encode(), salt1, iter1)
+    hash1 = pbkdf2_sha256(password, salt1, iter1)
     # Once with dynamic salt.
-    hash2 = hashlib.pbkdf2_hmac("sha256", hash1, salt2, iter2)
+    hash2 = pbkdf2_sha256(hash1, salt2, iter2)
     return f"{challenge_parts[4]}${hash2.hex()}"
 
-def calculate_md5_response(challenge: str, password: str) -> str:
+def pbkdf2_sha256(password: bytes, salt: bytes, iterations: int) -> bytes:
+    """
+    Derives a 32 byte PBKDF2-HMAC-SHA256 key.
+
+    Uses the cryptography package when it is installed and falls back to hashlib otherwise.
+
+    Parameters:
+        password (bytes): The password to derive the key from.
+        salt (bytes): The salt for the derivation.
+        iterations (int): The number of iterations.
+
+    Returns:
+        bytes: The derived key.
+    """
+    if PBKDF2HMAC is not None:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=iterations)
+        return kdf.derive(password)
+    if hasattr(hashlib, "pbkdf2_hmac"):
+        return hashlib.pbkdf2_hmac("sha256", password, salt, iterations)
+    return _pbkdf2_sha256_fast(password, salt, iterations, 32)
+
+def _pbkdf2_sha256_fast(password: bytes, salt: bytes, iterations: int, dklen: int) -> bytes:
+    """
+    Pure Python PBKDF2-HMAC-SHA256 for builds where hashlib has no pbkdf2_hmac.
+
+    The HMAC inner and outer pad states are hashed once per password and copied for
+    every iteration, so each U_i only costs the two SHA-256 updates over 32 bytes.
+    """
+    if len(password) > 64:
+        password = hashlib.sha256(password).digest()
+    password = password.ljust(64, b"\x00")
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in password))
+    outer = hashlib.sha256(bytes(b ^ 0x5C for b in password))
+
+    def prf(data: bytes) -> bytes:
+        inner_ctx = inner.copy()
+        inner_ctx.update(data)
+        outer_ctx = outer.copy()
+        outer_ctx.update(inner_ctx.digest())
+        return outer_ctx.digest()
+
+    key = b""
+    block_index = 1
+    while len(key) < dklen:
+        u = prf(salt + block_index.to_bytes(4, "big"))
+        result = int.from_bytes(u, "big")
+        for _ in range(iterations - 1):
+            u = prf(u)
+            result ^= int.from_bytes(u, "big")
+        key += result.to_bytes(32, "big")
+        block_index += 1
+    return key[:dklen]
+
+def calculate_md5_response(challenge: str, password: bytes) -> str:
     """
     Calculates the MD5 response for the given challenge and password.
 
     Parameters:
         challenge (str): The challenge string received during login.
-        password (str): The user's password.
+        password (bytes): The user's password, encoded as UTF-16-LE.
 
     Returns:
         str: The MD5 response in the format "challenge-md5_hex".
     """
-    response = challenge + "-" + password
     # the legacy response needs utf_16_le encoding
-    response = response.encode("utf_16_le")
-    md5_sum = hashlib.md5()
-    md5_sum.update(response)
-    response = challenge + "-" + md5_sum.hexdigest()
-    return response
+    response = f"{challenge}-".encode("utf_16_le") + password
+    md5_hex = hashlib.md5(response).hexdigest()
+    return f"{challenge}-{md5_hex}"
 
 def send_response(box_url: str, username: str, challenge_response: str) -> str:
     """
@@ -143,16 +288,14 @@ def send_response(box_url: str, username: str, challenge_response: str) -> str:
         Exception: If an error occurs during the response sending process.
     """
     # Build response params
-    post_data_dict = {"username": username, "response": challenge_response}
-    post_data = urllib.parse.urlencode(post_data_dict).encode()
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    post_data = {"username": username, "response": challenge_response}
     url = box_url + LOGIN_SID_ROUTE
     # Send response
-    http_request = urllib.request.Request(url, post_data, headers)
-    http_response = urllib.request.urlopen(http_request)
+    http_response = SESSION.post(url, data=post_data)
+    http_response.raise_for_status()
     # Parse SID from resulting XML.
-    xml = ET.fromstring(http_response.read())
-    return xml.find("SID").text
+    xml = read_xml_fields(http_response.content, "SID")
+    return xml["SID"]
 
 def unix_timestamp_from_strings(date_string: str, time_string: str) -> int:
     """
@@ -165,8 +308,15 @@ def unix_timestamp_from_strings(date_string: str, time_string: str) -> int:
     Returns:
         int: The Unix timestamp representing the provided date and time.
     """
-    datetime_string = f"{date_string} {time_string}"
-    datetime_obj = datetime.strptime(datetime_string, "%d.%m.%y %H:%M:%S")
+    day, month, year = date_string.split(".")
+    hour, minute, second = time_string.split(":")
+    if len(year) != 2 or not year.isdigit():
+        raise ValueError(f"Invalid two digit year in date: {date_string!r}")
+    year = int(year)
+    # Same two digit year pivot as strptime's %y
+    year += 2000 if year < 69 else 1900
+
+    datetime_obj = datetime(year, int(month), int(day), int(hour), int(minute), int(second))
 
     # Get the Unix timestamp
     unix_timestamp = int(datetime_obj.timestamp())
@@ -183,39 +333,97 @@ def get_last_timestamp(file_path: str) -> int:
     Returns:
         int: The last timestamp found in the CSV file or 1 if the file is empty or does not exist.
     """
+    block_size = 4096
     try:
-        with open(file_path, 'r') as file:
-            lines = file.readlines()
-            if lines:
-                last_line = lines[-1].strip()
-                timestamp = int(last_line.split(";")[0].strip())
-                return timestamp
-            else:
+        with open(file_path, 'rb') as file:
+            # Read backwards from the end until the last line is complete
+            position = file.seek(0, os.SEEK_END)
+            buffer = b""
+            while position > 0:
+                step = min(block_size, position)
+                position -= step
+                file.seek(position)
+                buffer = file.read(step) + buffer
+                if b"\n" in buffer.rstrip():
+                    break
+            last_line = buffer.rstrip().rsplit(b"\n", 1)[-1]
+            if not last_line:
                 return 1
+            return int(last_line.split(b";", 1)[0].strip())
     except Exception:
         return 1
 
-def create_or_append_to_csv(file_path: str, data: list, fieldnames: list):
+def read_last_timestamp(file_path: str) -> int:
+    """
+    Retrieves the last timestamp written to a CSV file.
+
+    The timestamp is read from the sidecar file written by create_or_append_to_csv.
+    If there is none, the tail of the CSV file is read instead.
+
+    Parameters:
+        file_path (str): The path to the CSV file.
+
+    Returns:
+        int: The last timestamp written or 1 if the CSV file is empty or does not exist.
+    """
+    if not os.path.isfile(file_path):
+        return 1
+    try:
+        with open(file_path + LAST_TIMESTAMP_SUFFIX, 'r') as file:
+            return int(file.readline())
+    except (OSError, ValueError):
+        return get_last_timestamp(file_path)
+
+def create_or_append_to_csv(file_path: str, data: list, fieldnames: list, last_timestamp: Optional[int] = None) -> int:
     """
     Creates or appends data to a CSV file based on the given fieldnames.
 
+    Only entries newer than the last written timestamp are appended. That timestamp is
+    stored in a sidecar file next to the CSV file once the CSV has been written, so the
+    next call does not need to read the CSV. A sidecar that is out of sync with the CSV
+    causes duplicate rows (if it is behind) or skipped rows (if it is ahead), so it is
+    removed if it cannot be updated and the next call falls back to reading the CSV.
+
     Parameters:
         file_path (str): The path to the CSV file.
-        data (list): A list of dictionaries containing the data to be written.
+        data (list): A list of dictionaries containing the data to be written, with int timestamps.
         fieldnames (list): A list of field names for the CSV file.
+        last_timestamp (Optional[int]): The last timestamp already in the file. Read with read_last_timestamp if None.
+
+    Returns:
+        int: The last timestamp in the file after appending.
     """
     file_exists = os.path.isfile(file_path)
+    if last_timestamp is None:
+        last_timestamp = read_last_timestamp(file_path)
+
+    # Sort by timestamp so all new entries are in one slice at the end
+    data = sorted(data, key=lambda entry: entry["Timestamp"])
+    timestamps = [entry["Timestamp"] for entry in data]
+    new_entries = data[bisect.bisect_right(timestamps, last_timestamp):]
+    if new_entries:
+        last_timestamp = timestamps[-1]
 
-    with open(file_path, mode='a', newline='') as csv_file:
+    with open(file_path, mode='a', newline='', buffering=CSV_BUFFER_SIZE) as csv_file:
         writer = csv.DictWriter(csv_file, fieldnames=fieldnames, delimiter=";")
         if not file_exists:
-            writer.writeheader()        
+            writer.writeheader()
 
-        last_timestamp = get_last_timestamp(file_path)
+        writer.writerows(new_entries)
+
+    # Only reached if the CSV was written successfully
+    sidecar_path = file_path + LAST_TIMESTAMP_SUFFIX
+    try:
+        with open(sidecar_path, 'w') as file:
+            file.write(f"{last_timestamp}\n")
+    except OSError:
+        # A stale sidecar would make the next run append these rows again
+        try:
+            os.remove(sidecar_path)
+        except OSError:
+            pass
 
-        for entry in data:
-            if int(entry["Timestamp"]) > last_timestamp:
-                writer.writerow(entry)
+    return last_timestamp
 
 def get_fritzbox_event_log(url:str, sid: str, excludes: list) -> list:
     """
@@ -242,59 +450,110 @@ def get_fritzbox_event_log(url:str, sid: str, excludes: list) -> list:
         'xhrId': 'log',
     }
 
-    response = requests.post(url, data=data)
+    response = SESSION.post(url, data=data)
 
     if response.status_code == 200:
         # Process the event log data in the response
-        event_log_data = response.text
-        # print(event_log_data)
-        jdata = json.loads(event_log_data)
+        # print(response.text)
+        jdata = json_loads(response.content)
         logData = jdata.get("data").get("log")
-        csvData = []
-        for entry in list(logData)[::-1]:
-            Message = entry[2]
-            if not is_excluded(Message, excludes):
-                cdata = {
-                    "Timestamp": f'{unix_timestamp_from_strings(entry[0], entry[1])}',
+        # Branch once, so no exclude check runs per entry when none are configured
+        if excludes:
+            excluded = compile_excludes(excludes)
+            csvData = [
+                {
+                    "Timestamp": unix_timestamp_from_strings(entry[0], entry[1]),
                     "Date": entry[0],
                     "Time": entry[1],
                     "Message": entry[2],
                     "Code": entry[3],
                 }
-                csvData.append(cdata)
-            # else:
-            #     print(f"Excluded Message: {Message}")
-            
+                for entry in reversed(logData)
+                if not excluded(entry[2])
+            ]
+        else:
+            csvData = [
+                {
+                    "Timestamp": unix_timestamp_from_strings(entry[0], entry[1]),
+                    "Date": entry[0],
+                    "Time": entry[1],
+                    "Message": entry[2],
+                    "Code": entry[3],
+                }
+                for entry in reversed(logData)
+            ]
 
         return csvData
     else:
         print(f"Failed to retrieve event log. Status code: {response.status_code}")
 
-def is_excluded(message: str, excludes: list) -> bool:
+def split_excludes(excludes: list) -> tuple:
+    """
+    Splits a list of exclusion criteria into single strings and lists of strings.
+
+    Parameters:
+        excludes (list): A list of strings or lists of strings representing exclusion criteria.
+
+    Returns:
+        tuple: A tuple of the single strings and a tuple of tuples with the grouped strings.
+    """
+    terms = tuple(item for item in excludes if isinstance(item, str))
+    groups = tuple(tuple(item) for item in excludes if isinstance(item, list))
+    return terms, groups
+
+def compile_excludes(excludes: list):
     """
-    Checks if a message is excluded based on a list of exclusion criteria.
+    Compiles a list of exclusion criteria into a single check function.
 
     The exclusion criteria can be either strings or lists of strings. For strings,
-    the function checks if the item is present in the message. For lists, the function
-    checks if all elements in the list are present in the message.
+    the check tests if the item is present in the message. For lists, it tests if
+    all elements in the list are present in the message. From EXCLUDE_SCAN_MIN_TERMS
+    strings on, they are searched in one pass over the message with an Aho-Corasick
+    automaton (pyahocorasick) or a single regular expression if pyahocorasick is not
+    installed. Below that plain substring checks are faster.
 
     Parameters:
-        message (str): The message to be checked for exclusion.
         excludes (list): A list of strings or lists of strings representing exclusion criteria.
 
     Returns:
-        bool: True if the message is excluded based on any exclusion criteria, False otherwise.
+        Callable[[str], bool]: A function returning True if a message is excluded.
     """
-    for item in excludes:
-        if isinstance(item, str):
-            # For string items, check if the item is present in the message
-            if item in message:
+    terms, groups = split_excludes(excludes)
+
+    def group_excluded(message: str) -> bool:
+        for group in groups:
+            if all(part in message for part in group):
+                return True
+        return False
+
+    if len(terms) < EXCLUDE_SCAN_MIN_TERMS:
+        def excluded(message: str) -> bool:
+            for term in terms:
+                if term in message:
+                    return True
+            for group in groups:
+                if all(part in message for part in group):
+                    return True
+            return False
+    elif ahocorasick is not None and all(terms):
+        automaton = ahocorasick.Automaton()
+        for term in terms:
+            automaton.add_word(term, term)
+        automaton.make_automaton()
+
+        def excluded(message: str) -> bool:
+            if next(automaton.iter(message), None) is not None:
                 return True
-        elif isinstance(item, list):
-            # For list items, check if all elements in the list are present in the message
-            if all(part in message for part in item):
+            return group_excluded(message)
+    else:
+        search = re.compile("|".join(map(re.escape, terms))).search
+
+        def excluded(message: str) -> bool:
+            if search(message) is not None:
                 return True
-    return False
+            return group_excluded(message)
+
+    return excluded
 
 def load_settings(path:str) -> dict:
     """
@@ -307,7 +566,7 @@ def load_settings(path:str) -> dict:
     """
     with open(path, "r") as file:
         # Load the YAML data from the file
-        data = yaml.safe_load(file)
+        data = yaml.load(file, Loader=SafeLoader)
         return data
 
 def main():
@@ -328,13 +587,20 @@ def main():
     password = Settings.get("password", "")
     excludes = Settings.get("exclude", [])
     LogPath = Settings.get("logpath", "fritzLog.csv")
-    sid = get_sid(url, username, password)
-    print(f"Successful login for user: {username}")
-    print(f"sid: {sid}")
 
-    log = get_fritzbox_event_log(url, sid, excludes)
+    # Read the last saved timestamp while logging in and downloading the log
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        last_timestamp_future = executor.submit(read_last_timestamp, LogPath)
+
+        sid = get_sid(url, username, password)
+        print(f"Successful login for user: {username}")
+        print(f"sid: {sid}")
+
+        log = get_fritzbox_event_log(url, sid, excludes)
+        last_timestamp = last_timestamp_future.result()
+
     keynames = list(log[0].keys())
-    create_or_append_to_csv(LogPath, log, keynames)
+    create_or_append_to_csv(LogPath, log, keynames, last_timestamp)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file